@@ -1,11 +1,19 @@
 import os
-import json
-from utils import sha256, load_public_key, verify
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from utils import (sha256, canonical_bytes, load_public_key, verify, read_witness, witness_records,
+                   build_merkle_tree, verify_merkle_proof, BloomFilter)
 from cryptography.hazmat.primitives import serialization
 
 class Verifier:
     def __init__(self, public_key_path):
         self.public_key = load_public_key(public_key_path)
+        # cached layer (tuple) -> root it hashes up to, for the most recently seen batches
+        self._layer_roots = functools.lru_cache(maxsize=256)(build_merkle_tree)
+        self._blooms = {}  # witness file -> (bytes of the log parsed, BloomFilter built from them)
+        
+        # The key never changes, so a verdict for given (event bytes, signature) is fixed: memoize it
+        self._verify_event = functools.lru_cache(maxsize=4096)(self._check_signature)
     
     def verify_download(self, verification_package):
         if not verification_package:
@@ -25,8 +33,8 @@ class Verifier:
         
         # Check 2: Event Authenticity
         if signature:
-            signature_bytes = bytes.fromhex(signature) if isinstance(signature, str) else signature
-            if not verify(event, signature_bytes, self.public_key):
+            signature_bytes = bytes.fromhex(signature) if isinstance(signature, str) else bytes(signature)
+            if not self._verify_event(canonical_bytes(event), signature_bytes):
                 return False, "Check 2 FAILED: Event signature invalid"
         else:
             return False, "Check 2 FAILED: No signature provided"
@@ -36,12 +44,26 @@ class Verifier:
             return False, "Check 3 FAILED: No batch header"
         
         batch_events = latest_batch.get("events", [])
+        # Hash the event being verified once; the batch already lists every other leaf digest
         event_hash = sha256(event)
-        event_hashes = [sha256(e["event"]) for e in batch_events]
+        event_hashes = {e["event_digest"] if "event_digest" in e else sha256(e["event"]) for e in batch_events}
         
         if event_hash not in event_hashes:
             return False, "Check 3 FAILED: Event not found in batch"
         
+        # The root, cached layer and proof below are only meaningful if the HSM signed this header
+        header = latest_batch.get("header", {})
+        batch_signature = bytes.fromhex(latest_batch.get("signature", ""))
+        if not self._verify_event(canonical_bytes(header), batch_signature):
+            return False, "Check 3 FAILED: Batch header signature invalid"
+        
+        cached_layer = header.get("cached_layer")
+        if cached_layer is not None and self._layer_root(cached_layer) != header.get("merkle_root"):
+            return False, "Check 3 FAILED: Cached Merkle layer does not match root"
+        if not verify_merkle_proof(event_hash, merkle_proof.get("path", []), header.get("merkle_root", ""),
+                                   merkle_proof.get("event_index", 0), cached_layer):
+            return False, "Check 3 FAILED: Merkle proof invalid"
+        
         # Check 4: Public Witness
         witness_file = "witness_logs/witness1.txt"
         if not os.path.exists(witness_file):
@@ -49,26 +71,67 @@ class Verifier:
         
         return True, "All checks PASSED. File is authentic."
     
+    def _check_signature(self, data, signature):
+        return verify(data, signature, self.public_key)
+    
+    def _layer_root(self, cached_layer):
+        """Hash a batch's cached layer up to its root once; later proofs stop at the layer"""
+        return self._layer_roots(tuple(cached_layer))
+    
     def audit_missing_file(self, file_hash, witness_dir="witness_logs/"):
         found_upload = False
         found_delete = False
         evidence = []
         
-        for i in range(1, 4):
-            witness_file = os.path.join(witness_dir, f"witness{i}.txt")
-            if not os.path.exists(witness_file):
-                continue
-            
-            with open(witness_file, 'r') as f:
-                for line in f:
-                    batch = json.loads(line)
-                    for e in batch["events"]:
-                        if e["event"]["file_hash"] == file_hash:
-                            if e["event"]["action"] == "upload":
-                                found_upload = True
-                                evidence.append(f"Found upload at {e['event']['timestamp']} in {witness_file}")
-                            elif e["event"]["action"] == "delete":
-                                found_delete = True
-                                evidence.append(f"Found delete at {e['event']['timestamp']}")
-        
-        return found_upload, found_delete, evidence
\ No newline at end of file
+        # Scan the witnesses concurrently; results come back in witness order
+        witness_files = [os.path.join(witness_dir, f"witness{i}.txt") for i in range(1, 4)]
+        with ThreadPoolExecutor(max_workers=len(witness_files)) as pool:
+            results = pool.map(lambda w: self._scan_witness(w, file_hash), witness_files)
+        
+        for upload, delete, found in results:
+            found_upload |= upload
+            found_delete |= delete
+            evidence.extend(found)
+        
+        return found_upload, found_delete, evidence
+    
+    def _scan_witness(self, witness_file, file_hash):
+        """Collect upload/delete evidence for a file hash from one witness log"""
+        found_upload = False
+        found_delete = False
+        evidence = []
+        if not os.path.exists(witness_file):
+            return found_upload, found_delete, evidence
+        
+        # A negative Bloom lookup proves the hash never appears in this witness
+        if file_hash not in self._witness_bloom(witness_file):
+            return found_upload, found_delete, evidence
+        
+        for batch in read_witness(witness_file):
+            for e in batch["events"]:
+                if e["event"]["file_hash"] == file_hash:
+                    if e["event"]["action"] == "upload":
+                        found_upload = True
+                        evidence.append(f"Found upload at {e['event']['timestamp']} in {witness_file}")
+                    elif e["event"]["action"] == "delete":
+                        found_delete = True
+                        evidence.append(f"Found delete at {e['event']['timestamp']}")
+        
+        return found_upload, found_delete, evidence
+    
+    def _witness_bloom(self, witness_file):
+        """
+        Bloom filter of the file hashes in a witness log, built by the Verifier itself from
+        the records it parses. Only records appended since the last audit are read; a log
+        that shrank (truncated or replaced) is parsed again from the start.
+        """
+        parsed, bloom = self._blooms.get(witness_file, (0, None))
+        if bloom is None or os.path.getsize(witness_file) < parsed:
+            parsed, bloom = 0, BloomFilter()
+        
+        for parsed, batch in witness_records(witness_file, parsed):
+            for e in batch["events"]:
+                bloom.add(e["event"]["file_hash"])
+        
+        self._blooms[witness_file] = (parsed, bloom)
+        return bloom
@@ -1,5 +1,5 @@
 import os
-from utils import sha256, load_private_key, sign
+from utils import sha256_raw, canonical_bytes, load_private_key, sign, MerkleAccumulator
 
 class HSM_Simulator:
     """Simulates TPM/HSM: stores private key and chain state securely"""
@@ -17,31 +17,46 @@ class HSM_Simulator:
         self.private_key = load_private_key(private_key_path)
         self.public_key_path = os.path.join(key_dir, "public_key.pem")
         
-        # HSM-protected state: latest event hash (chain head)
-        self.latest_event_hash = sha256("genesis")
+        # HSM-protected state: latest event hash (chain head), kept as raw digest
+        self.latest_event_hash = sha256_raw("genesis")
+        
+        # Merkle tree of the events signed since the last batch was sealed
+        self.batch_tree = MerkleAccumulator()
     
     def chain_and_sign(self, event):
         """
         Simulate HSM atomic operation:
         1. Updates chain hash
         2. Signs event
-        Returns (new_chain_hash, signature)
+        3. Adds the event hash to the open batch's Merkle tree
+        Returns (new_chain_hash, signature, event_hash), hashes as raw bytes
         """
-        # Chain the event: Hash_N = SHA256( SHA256(Event) + Hash_N-1 )
-        event_hash = sha256(event)
-        event_hash_bytes = bytes.fromhex(event_hash)
-        prev_hash_bytes = bytes.fromhex(self.latest_event_hash)
+        # Serialize once; the same bytes are hashed and signed
+        event_bytes = canonical_bytes(event)
         
-        new_chain_hash = sha256(event_hash_bytes + prev_hash_bytes)
+        # Chain the event: Hash_N = SHA256( SHA256(Event) + Hash_N-1 )
+        event_hash = sha256_raw(event_bytes)
+        new_chain_hash = sha256_raw(event_hash + self.latest_event_hash)
         
         # Update HSM state (atomically, in real hardware)
         self.latest_event_hash = new_chain_hash
         
         # Sign the event data (not the chain hash)
-        signature = sign(event, self.private_key)
+        signature = sign(event_bytes, self.private_key)
         
-        return new_chain_hash, signature
+        self.batch_tree.append(event_hash)
+        
+        return new_chain_hash, signature, event_hash
+    
+    def seal_batch(self):
+        """Hand over the open batch's Merkle tree and start a new one"""
+        tree, self.batch_tree = self.batch_tree, MerkleAccumulator()
+        return tree
+    
+    def restore_chain_head(self, chain_hash):
+        """Resume the event chain from a published head (hex), e.g. the last batch's final_chain_hash"""
+        self.latest_event_hash = bytes.fromhex(chain_hash)
     
     def get_latest_hash(self):
-        """Get current chain head"""
-        return self.latest_event_hash
\ No newline at end of file
+        """Get current chain head (hex)"""
+        return self.latest_event_hash.hex()
\ No newline at end of file
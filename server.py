@@ -1,9 +1,16 @@
 import os
 import time
 import json
-from utils import sha256, build_merkle_tree, sign
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils import (sha256, sha256_raw, sha256_file, sign, canonical_bytes, read_witness, merkle_levels, merkle_path,
+                   cached_merkle_layer, MERKLE_CACHE_DEPTH)
 from hsm_sim import HSM_Simulator
 
+# Merkle trees of the most recently used batches kept for proof generation (others are rebuilt on demand)
+MAX_CACHED_BATCH_TREES = 16
+
 class PublicRecordsServer:
     def __init__(self, base_dir="."):
         self.base_dir = base_dir
@@ -22,19 +29,36 @@ class PublicRecordsServer:
         
         # Initialize components
         self.hsm = HSM_Simulator(os.path.join(base_dir, "keys"))
-        self.events = []  # List of (event, chain_hash, signature)
+        self.events = []  # List of (event, chain_hash bytes, signature, event_digest bytes)
         self.batch_number = 0
+        self._upload_index = None  # file_hash -> (batch, event_data, event_index), built lazily from witnesses
+        self._batch_levels = OrderedDict()  # merkle_root -> Merkle levels, LRU for proof generation
+        
+        # Chain batches to the real previous header; read from the log tail once, then kept in memory
+        self._last_batch_header = None
+        previous_header = self.load_previous_batch_header()
+        self._last_batch_header_hash = sha256(previous_header) if previous_header else sha256("genesis")
+        if previous_header:
+            # Continue both chains where the last published batch left them
+            self.batch_number = previous_header["batch_number"] + 1
+            self.hsm.restore_chain_head(previous_header["final_chain_hash"])
         self.public_key_path = os.path.join(base_dir, "keys", "public_key.pem")
     
     def upload(self, file_path):
         """Simulate file upload, return SUR"""
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-        
-        file_hash = sha256(file_content)
-        file_store_path = os.path.join(self.uploads_dir, file_hash)
-        with open(file_store_path, 'wb') as f:
-            f.write(file_content)
+        # Stream into the object store while hashing, then move it to its content address
+        fd, tmp_path = tempfile.mkstemp(dir=self.uploads_dir, prefix=".incoming-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                file_hash = sha256_file(file_path, out=f)
+            # mkstemp creates 0600; give stored objects the mode open() would have (0666 less the umask)
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, os.path.join(self.uploads_dir, file_hash))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
         
         event = {
             "action": "upload",
@@ -43,15 +67,15 @@ class PublicRecordsServer:
             "filename": os.path.basename(file_path)
         }
         
-        chain_hash, signature = self.hsm.chain_and_sign(event)
+        chain_hash, signature, event_digest = self.hsm.chain_and_sign(event)
         
-        # Store all three elements
-        self.events.append((event, chain_hash, signature))
+        # Store all four elements
+        self.events.append((event, chain_hash, signature, event_digest))
         
         return {
             "event": event,
             "signature": signature.hex(),
-            "chain_hash": chain_hash
+            "chain_hash": chain_hash.hex()
         }
     
     def delete(self, file_hash, user_id="admin"):
@@ -67,8 +91,8 @@ class PublicRecordsServer:
             "user_id": user_id
         }
         
-        chain_hash, signature = self.hsm.chain_and_sign(event)
-        self.events.append((event, chain_hash, signature))
+        chain_hash, signature, event_digest = self.hsm.chain_and_sign(event)
+        self.events.append((event, chain_hash, signature, event_digest))
         
         return {"event": event, "signature": signature.hex()}
     
@@ -78,60 +102,102 @@ class PublicRecordsServer:
             print("No events to batch")
             return
         
-        # Unpack 3 elements correctly
-        event_hashes = [sha256(e) for e, _, _ in self.events]
-        merkle_root = build_merkle_tree(event_hashes)
+        # The HSM already folded each event into the batch tree; only its right edge is left.
+        # The tree is sealed only after the witnesses are written, so a failed publish can be retried.
+        levels = self.hsm.batch_tree.levels()
+        merkle_root = levels[-1][0].hex()
         
         final_chain_hash = self.hsm.get_latest_hash()
-        prev_batch_hash = sha256(f"batch_{self.batch_number-1}") if self.batch_number > 0 else sha256("genesis")
+        prev_batch_hash = self._last_batch_header_hash
         
         batch_header = {
             "batch_number": self.batch_number,
             "merkle_root": merkle_root,
+            "cached_layer": cached_merkle_layer(levels, MERKLE_CACHE_DEPTH),
             "final_chain_hash": final_chain_hash,
             "previous_batch_header_hash": prev_batch_hash,
             "timestamp": time.time()
         }
         
-        batch_signature = sign(json.dumps(batch_header), self.hsm.private_key)
+        # Serialize once; the same bytes are signed and become the next batch's link
+        header_bytes = canonical_bytes(batch_header)
+        batch_signature = sign(header_bytes, self.hsm.private_key)
         
-        # Package with all three elements
+        # Package with all four elements; event_digest is the Merkle leaf, so nobody has to rehash events
         batch_package = {
             "header": batch_header,
             "signature": batch_signature.hex(),
-            "events": [{"event": e, "signature": sig.hex(), "chain_hash": h} for e, h, sig in self.events]
+            "events": [{"event": e, "signature": sig.hex(), "chain_hash": h.hex(), "event_digest": d.hex()}
+                       for e, h, sig, d in self.events]
         }
         
-        # Publish to witnesses
-        for i in range(1, 4):
-            witness_file = os.path.join(self.witness_dir, f"witness{i}.txt")
-            with open(witness_file, 'a') as f:
-                f.write(json.dumps(batch_package) + "\n")
+        # Publish to witnesses (serialize once, compactly, and append the same bytes everywhere in parallel)
+        payload = (json.dumps(batch_package, separators=(",", ":")) + "\n").encode()
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            list(pool.map(lambda i: self._append_witness(i, payload), range(1, 4)))
         
         print(f"Batch {self.batch_number} published to witnesses")
         print(f"  Merkle Root: {merkle_root[:32]}...")
         print(f"  Events: {len(self.events)}")
         
+        self._cache_levels(merkle_root, levels)
+        self._last_batch_header = batch_header
+        self._last_batch_header_hash = sha256(header_bytes)
+        if self._upload_index is not None:
+            self._index_batch(batch_package)
+        
+        self.hsm.seal_batch()
         self.events.clear()
         self.batch_number += 1
         
         return batch_package
     
+    def _append_witness(self, witness_id, payload):
+        """Append one serialized batch line to a witness log"""
+        witness_file = os.path.join(self.witness_dir, f"witness{witness_id}.txt")
+        with open(witness_file, 'ab') as f:
+            f.write(payload)
+    
     def load_previous_batch_header(self):
-        """Load previous batch header from witness1"""
+        """Load previous batch header (cached once known, else read from the tail of witness1)"""
+        if self._last_batch_header is not None:
+            return self._last_batch_header
+        
         witness_file = os.path.join(self.witness_dir, "witness1.txt")
         if not os.path.exists(witness_file):
             return None
         
-        with open(witness_file, 'r') as f:
-            lines = f.readlines()
-            if not lines:
-                return None
-            last_line = lines[-1].strip()
-            if not last_line:
-                return None
-            batch = json.loads(last_line)
-            return batch.get("header", {})
+        with open(witness_file, 'rb') as f:
+            # Read backwards from EOF, doubling the window, until a complete line parses.
+            # Bytes after the last newline are a torn append and are ignored.
+            pos = f.seek(0, os.SEEK_END)
+            tail = b""
+            window = 4096
+            terminated = False
+            while pos > 0:
+                step = min(window, pos)
+                pos -= step
+                f.seek(pos)
+                tail = f.read(step) + tail
+                window *= 2
+                if not terminated:
+                    nl = tail.rfind(b"\n")
+                    if nl == -1:
+                        continue
+                    tail, terminated = tail[:nl], True
+                
+                # The first piece may start mid-line unless the file start was reached; keep it for the next window
+                lines = tail.split(b"\n")
+                tail = lines.pop(0) if pos > 0 else b""
+                for line in reversed(lines):
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:
+                        continue  # Blank or corrupt line: fall back to the one before it
+                    self._last_batch_header = batch.get("header", {})
+                    return self._last_batch_header
+        
+        return None
     
     def download(self, file_hash):
         """Simulate file download with verification package"""
@@ -142,26 +208,56 @@ class PublicRecordsServer:
         with open(file_path, 'rb') as f:
             file_content = f.read()
         
-        # Search through ALL batches across all witnesses
+        if self._upload_index is None:
+            self._load_upload_index()
+        
+        indexed = self._upload_index.get(file_hash)
+        if indexed is None:
+            return None
+        
+        batch, event_data, event_index = indexed
+        # Return the batch that CONTAINS this event
+        return {
+            "file_content": file_content,
+            "event": event_data["event"],
+            "signature": event_data["signature"],
+            "merkle_proof": {"event_index": event_index, "path": self._merkle_path(batch, event_index)},
+            "latest_batch": batch  # This is the CORRECT batch
+        }
+    
+    def _index_batch(self, batch):
+        """Record the upload events of a published batch (earliest batch wins)"""
+        for event_index, event_data in enumerate(batch["events"]):
+            if event_data["event"]["action"] == "upload":
+                self._upload_index.setdefault(event_data["event"]["file_hash"], (batch, event_data, event_index))
+    
+    def _merkle_path(self, batch, event_index):
+        """Proof from an event up to the batch's cached layer (or root for older headers)"""
+        header = batch["header"]
+        levels = self._batch_levels.get(header["merkle_root"])
+        if levels is None:
+            # Published digests are the leaves (older batches lack event_digest)
+            levels = merkle_levels([
+                e["event_digest"] if "event_digest" in e else sha256_raw(e["event"])
+                for e in batch["events"]
+            ])
+        self._cache_levels(header["merkle_root"], levels)
+        depth = MERKLE_CACHE_DEPTH if "cached_layer" in header else 0
+        return merkle_path(levels, event_index, depth)
+    
+    def _cache_levels(self, merkle_root, levels):
+        """Remember a batch's Merkle levels, evicting the least recently used beyond the cap"""
+        self._batch_levels[merkle_root] = levels
+        self._batch_levels.move_to_end(merkle_root)
+        while len(self._batch_levels) > MAX_CACHED_BATCH_TREES:
+            self._batch_levels.popitem(last=False)
+    
+    def _load_upload_index(self):
+        """Cold start: rebuild the upload index with one pass over the first available witness"""
+        self._upload_index = {}
         for witness_id in range(1, 4):
             witness_file = os.path.join(self.witness_dir, f"witness{witness_id}.txt")
-            if not os.path.exists(witness_file):
-                continue
-            
-            with open(witness_file, 'r') as f:
-                for line in f:
-                    batch = json.loads(line)
-                    # Search events in this batch
-                    for event_data in batch["events"]:
-                        if (event_data["event"]["file_hash"] == file_hash and 
-                            event_data["event"]["action"] == "upload"):
-                            # Return the batch that CONTAINS this event
-                            return {
-                                "file_content": file_content,
-                                "event": event_data["event"],
-                                "signature": event_data["signature"],
-                                "merkle_proof": {"event_index": 0},
-                                "latest_batch": batch  # This is the CORRECT batch
-                            }
-        
-        return None
\ No newline at end of file
+            if os.path.exists(witness_file):
+                for batch in read_witness(witness_file):
+                    self._index_batch(batch)
+                break
@@ -1,22 +1,97 @@
 import hashlib
 import json
+import mmap
 import os
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
 from cryptography.hazmat.backends import default_backend
 
+# Levels below the Merkle root published in each batch header; proofs stop there
+MERKLE_CACHE_DEPTH = 2
+
+def canonical_bytes(data):
+    """Encode bytes, string, or dict into the canonical form that gets hashed/signed"""
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    if isinstance(data, dict):
+        return json.dumps(data, sort_keys=True).encode()
+    return data.encode()
+
 def sha256(data):
     """Hash bytes, string, or dict"""
-    if isinstance(data, dict):
-        data = json.dumps(data, sort_keys=True).encode()
-    elif isinstance(data, str):
-        data = data.encode()
-    return hashlib.sha256(data).hexdigest()
+    # hashlib is backed by OpenSSL, which already dispatches to SHA-NI / ARMv8 SHA2
+    return hashlib.sha256(canonical_bytes(data)).hexdigest()
+
+def sha256_raw(data):
+    """Same as sha256() but returns the raw 32-byte digest, for internal use"""
+    return hashlib.sha256(canonical_bytes(data)).digest()
+
+def sha256_file(path, out=None, bufsize=1 << 20):
+    """Hash a file in fixed-size chunks, optionally copying each chunk to `out`"""
+    h = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        while chunk := f.read(bufsize):
+            h.update(chunk)
+            if out is not None:
+                out.write(chunk)
+    return h.hexdigest()
+
+def witness_records(witness_file, start=0):
+    """
+    Yield (end offset, batch) for each complete record from byte `start` of a witness log
+    (memory-mapped, split on newlines). An unterminated last line is a torn append and is
+    left for a later read; lines that do not parse are skipped.
+    """
+    with open(witness_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= start:
+            return  # Nothing new (and mmap cannot map an empty file)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = start
+            while (nl := mm.find(b"\n", pos)) != -1:
+                try:
+                    batch = json.loads(mm[pos:nl])
+                except ValueError:
+                    batch = None
+                pos = nl + 1
+                if batch is not None:
+                    yield pos, batch
+
+def read_witness(witness_file):
+    """Yield each published batch from a witness log"""
+    for _, batch in witness_records(witness_file):
+        yield batch
+
+class BloomFilter:
+    """Bloom filter over hex SHA-256 digests; bit positions are sliced from the digest itself"""
+    
+    HASHES = 3
+    
+    def __init__(self, size_bits=1 << 20):
+        self.bits = bytearray(size_bits // 8)
+        self.size_bits = size_bits
+    
+    def _positions(self, key):
+        # File hashes are already SHA-256 hex; anything else is hashed first so lookups never raise
+        try:
+            digest = bytes.fromhex(key)
+        except ValueError:
+            digest = b""
+        if len(digest) != 32:
+            digest = hashlib.sha256(key.encode()).digest()
+        for i in range(self.HASHES):
+            yield int.from_bytes(digest[8 * i:8 * i + 8], "big") % self.size_bits
+    
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
 
 def generate_keys(key_dir="keys/"):
-    """Generate ECDSA P-384 keys (simulating HSM keygen)"""
+    """Generate Ed25519 keys (simulating HSM keygen)"""
     os.makedirs(key_dir, exist_ok=True)
-    private_key = ec.generate_private_key(ec.SECP384R1(), default_backend())
+    private_key = ed25519.Ed25519PrivateKey.generate()
     
     # Save private key (simulated HSM storage)
     with open(os.path.join(key_dir, "private_key.pem"), "wb") as f:
@@ -39,92 +114,155 @@ def generate_keys(key_dir="keys/"):
 def load_private_key(key_path):
     """Load private key (simulated HSM access)"""
     with open(key_path, "rb") as f:
-        return serialization.load_pem_private_key(f.read(), None, default_backend())
+        key = serialization.load_pem_private_key(f.read(), None, default_backend())
+    if not isinstance(key, ed25519.Ed25519PrivateKey):
+        raise ValueError(f"{key_path} is not an Ed25519 key (left from the P-384 build?); "
+                         "remove the key directory to generate a new pair")
+    return key
 
 def load_public_key(key_path):
     """Load public key for verification"""
     with open(key_path, "rb") as f:
-        return serialization.load_pem_public_key(f.read(), default_backend())
+        key = serialization.load_pem_public_key(f.read(), default_backend())
+    if not isinstance(key, ed25519.Ed25519PublicKey):
+        raise ValueError(f"{key_path} is not an Ed25519 public key; fetch the server's current key")
+    return key
 
 def sign(data, private_key):
-    """Sign data with ECDSA"""
-    if isinstance(data, dict):
-        data = json.dumps(data, sort_keys=True).encode()
-    elif isinstance(data, str):
-        data = data.encode()
-    
-    return private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+    """Sign data with Ed25519"""
+    return private_key.sign(canonical_bytes(data))
 
 def verify(data, signature, public_key):
-    """Verify ECDSA signature"""
-    if isinstance(data, dict):
-        data = json.dumps(data, sort_keys=True).encode()
-    elif isinstance(data, str):
-        data = data.encode()
-    
+    """Verify Ed25519 signature"""
     try:
-        public_key.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+        public_key.verify(signature, canonical_bytes(data))
         return True
     except:
         return False
 
+def _leaf_bytes(leaves):
+    """Normalize hex/bytes leaves to raw digests once, before any level is hashed"""
+    return [bytes.fromhex(leaf) if isinstance(leaf, str) else leaf for leaf in leaves]
+
+def _merkle_level(nodes):
+    """Hash one tree level pairwise (raw digests), duplicating the last node on odd counts"""
+    if len(nodes) % 2:
+        nodes = nodes + [nodes[-1]]
+    # Kept single-threaded on purpose: hashlib only releases the GIL for inputs of
+    # 2 KiB or more, so 64-byte pair hashes would serialize on it in a thread pool
+    digest = hashlib.sha256
+    return [digest(left + right).digest() for left, right in zip(nodes[::2], nodes[1::2])]
+
+def merkle_levels(leaves):
+    """Build every level of the Merkle tree as raw digests, leaves first and root last"""
+    levels = [_leaf_bytes(leaves)]
+    while len(levels[-1]) > 1:
+        levels.append(_merkle_level(levels[-1]))
+    return levels
+
 def build_merkle_tree(leaves):
     """Build Merkle tree from list of hex hashes, return root"""
     if not leaves:
         return sha256("empty")
     
-    # Ensure leaves are bytes
-    leaf_bytes = [bytes.fromhex(leaf) if isinstance(leaf, str) else leaf for leaf in leaves]
-    
-    tree = [leaf_bytes]
-    while len(tree[-1]) > 1:
-        level = []
-        for i in range(0, len(tree[-1]), 2):
-            left = tree[-1][i]
-            right = tree[-1][i+1] if i+1 < len(tree[-1]) else left
-            combined = hashlib.sha256(left + right).digest()
-            level.append(combined)
-        tree.append(level)
+    # Stay on raw digests until the root
+    level = _leaf_bytes(leaves)
+    while len(level) > 1:
+        level = _merkle_level(level)
     
-    return tree[-1][0].hex()  # Return root as hex string
+    return level[0].hex()  # Return root as hex string
 
-def merkle_proof(leaf_index, leaves):
-    """Generate minimal Merkle proof"""
-    if leaf_index >= len(leaves):
-        return []
+class MerkleAccumulator:
+    """Incremental Merkle tree: O(1) amortized hashes per leaf, same shape as merkle_levels()"""
+    
+    def __init__(self):
+        self._nodes = [[]]  # Completed nodes per level (leaves first)
+    
+    def __len__(self):
+        return len(self._nodes[0])
+    
+    def append(self, leaf):
+        """Add a leaf, folding each completed sibling pair into the level above"""
+        digest = hashlib.sha256
+        node = leaf if isinstance(leaf, bytes) else bytes.fromhex(leaf)
+        height = 0
+        while True:
+            level = self._nodes[height]
+            level.append(node)
+            if len(level) % 2:
+                return
+            node = digest(level[-2] + node).digest()
+            height += 1
+            if height == len(self._nodes):
+                self._nodes.append([])
+    
+    def _closed_levels(self):
+        """Yield (completed nodes, right-edge node or None) per level, up to the root"""
+        digest = hashlib.sha256
+        carry = None
+        height = 0
+        while True:
+            full = self._nodes[height] if height < len(self._nodes) else []
+            yield full, carry
+            if len(full) + (carry is not None) <= 1:
+                return
+            # Close the odd right edge the same way _merkle_level pads it
+            if len(full) % 2:
+                carry = digest(full[-1] + (full[-1] if carry is None else carry)).digest()
+            elif carry is not None:
+                carry = digest(carry + carry).digest()
+            height += 1
+    
+    def levels(self):
+        """Every level as raw digests; only the right edge (O(log N) nodes) is hashed here"""
+        return [full if carry is None else full + [carry] for full, carry in self._closed_levels()]
     
+    def root(self):
+        """Current root as hex, matching build_merkle_tree() over the same leaves"""
+        if not len(self):
+            return sha256("empty")
+        for full, carry in self._closed_levels():
+            pass
+        return (full[0] if carry is None else carry).hex()
+
+def cached_merkle_layer(levels, depth=MERKLE_CACHE_DEPTH):
+    """Layer `depth` levels below the root (at most 2**depth nodes), as hex"""
+    return [node.hex() for node in levels[max(len(levels) - 1 - depth, 0)]]
+
+def merkle_path(levels, leaf_index, cached_depth=0):
+    """Sibling path for a leaf, stopping `cached_depth` levels below the root"""
     proof = []
     index = leaf_index
-    tree = leaves
-    
-    while len(tree) > 1:
-        if index % 2 == 0 and index + 1 < len(tree):
-            proof.append(tree[index + 1].hex() if isinstance(tree[index + 1], bytes) else tree[index + 1])
-        elif index % 2 == 1:
-            proof.append(tree[index - 1].hex() if isinstance(tree[index - 1], bytes) else tree[index - 1])
-        
-        # Build next level
-        next_level = []
-        for i in range(0, len(tree), 2):
-            left = tree[i]
-            right = tree[i+1] if i+1 < len(tree) else left
-            combined = hashlib.sha256(
-                (left if isinstance(left, bytes) else bytes.fromhex(left)) + 
-                (right if isinstance(right, bytes) else bytes.fromhex(right))
-            ).digest()
-            next_level.append(combined)
-        
-        tree = next_level
+    for level in levels[:max(len(levels) - 1 - cached_depth, 0)]:
+        # Odd levels duplicate their last node, so it is its own sibling
+        sibling = index ^ 1 if (index ^ 1) < len(level) else index
+        proof.append(level[sibling].hex())
         index //= 2
-    
     return proof
 
-def verify_merkle_proof(leaf, proof, root):
-    """Verify Merkle proof"""
+def merkle_proof(leaf_index, leaves, cached_depth=0):
+    """Generate minimal Merkle proof"""
+    if leaf_index >= len(leaves):
+        return []
+    return merkle_path(merkle_levels(leaves), leaf_index, cached_depth)
+
+def verify_merkle_proof(leaf, proof, root, leaf_index=0, cached_layer=None):
+    """
+    Verify Merkle proof against the root, or against a cached layer
+    (the caller must already have checked that the layer hashes up to root)
+    """
+    digest = hashlib.sha256
     current = leaf if isinstance(leaf, bytes) else bytes.fromhex(leaf)
+    index = leaf_index
     
     for sibling in proof:
         sibling_bytes = sibling if isinstance(sibling, bytes) else bytes.fromhex(sibling)
-        current = hashlib.sha256(current + sibling_bytes).digest()
+        if index % 2:
+            current = digest(sibling_bytes + current).digest()
+        else:
+            current = digest(current + sibling_bytes).digest()
+        index //= 2
     
+    if cached_layer is not None:
+        return index < len(cached_layer) and current.hex() == cached_layer[index]
     return current.hex() == (root if isinstance(root, str) else root.hex())
\ No newline at end of file